@@ -27,6 +27,7 @@ def run_peer():
         print("  5 - CHAT")
         print("  6 - DOWNLOAD")
         print("  7 - SAIR")
+        print("  8 - SEARCH_MANY")
         opcao = input("Escolha: ").strip()
 
         if opcao == "1":
@@ -55,7 +56,11 @@ def run_peer():
         elif opcao == "7":
             p.unregister()
             print("Encerrando Peer...")
+            p.close()
             break
+        elif opcao == "8":
+            filenames = input("Nomes dos arquivos (ex: file1.txt,file2.jpg): ").strip()
+            p.search_many([fn for fn in filenames.split(",") if fn])
         else:
             print("Opção inválida.")
 
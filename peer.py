@@ -1,7 +1,271 @@
+import asyncio
 import socket
 import threading
 import time
 import os
+import re
+import mmap
+import functools
+import logging
+import selectors
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import protocol
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Buffer de recepção do socket do tracker; o PEER_LIST pode ser grande
+TRACKER_RCVBUF = 256 * 1024
+# Mensagens por chunk/keepalive: nível DEBUG, desligadas por padrão; o
+# que o usuário precisa ver continua no print
+log = logging.getLogger("peer")
+
+# Cabeçalhos das respostas do tracker com várias linhas
+_SEARCH_RESULT = b"SEARCH_RESULT "
+_SEARCH_MANY_RESULT = b"SEARCH_MANY_RESULT "
+_PEER_LIST = b"PEER_LIST "
+# Intervalo para juntar os INCREMENT_SCORE dos chunks servidos num só envio
+SCORE_FLUSH_INTERVAL = 0.25
+# Transferência de arquivos: leituras grandes e buffers do kernel maiores
+# que o padrão; as mensagens de controle continuam limitadas a 4 KiB
+DOWNLOAD_RECV_SIZE = 256 * 1024
+TRANSFER_SOCKET_BUFFER = 4 * 1024 * 1024
+# Conexões ociosas guardadas por peer de destino, reusadas entre pedidos
+PEER_POOL_SIZE = 8
+# Validade do tamanho de arquivo já consultado via FILE_SIZE (segundos)
+FILE_SIZE_TTL = 900
+# Arquivos mantidos abertos para servir FILE_SIZE/DOWNLOAD: fatias do cache
+# e arquivos por fatia
+OPEN_FILE_CACHE_SHARDS = 8
+OPEN_FILE_CACHE_SIZE = 64
+# Sem os.sendfile (Windows), socket.sendfile lê o arquivo pela posição
+# corrente; nesse caso o upload não pode usar um arquivo compartilhado
+_HAS_SENDFILE = hasattr(os, "sendfile")
+# Threads que atendem conexões de outros peers (CHAT, FILE_SIZE, DOWNLOAD)
+HANDLER_WORKERS = 32
+# Tempo máximo de uma conexão de outro peer parada no meio de um pedido
+PEER_CONN_TIMEOUT = 30
+# Conexão ociosa entre pedidos: fica no selector do listener, sem ocupar
+# worker, e é fechada depois deste tempo
+PEER_IDLE_TIMEOUT = 60
+# Conexão no pool de quem baixa: descartada bem antes de o outro peer
+# fechá-la por ociosidade, para não ser fechada no meio de um pedido
+PEER_POOL_IDLE = PEER_IDLE_TIMEOUT // 2
+
+def _interface_ip():
+    # Fallback sem rota padrão: primeiro IPv4 de uma interface ativa
+    stats = psutil.net_if_stats()
+    for name, addrs in psutil.net_if_addrs().items():
+        if name == "lo" or name not in stats or not stats[name].isup:
+            continue
+        for a in addrs:
+            if a.family == socket.AF_INET and not a.address.startswith("127."):
+                return a.address
+    return None
+
+@functools.lru_cache(maxsize=1)
+def get_local_ip():
+    # connect() em UDP não envia nada: só pede ao kernel a rota padrão, e o
+    # endereço de origem dela é o que os outros peers conseguem alcançar
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    except OSError:
+        pass
+    finally:
+        s.close()
+    if psutil is not None:
+        local_ip = _interface_ip()
+        if local_ip:
+            return local_ip
+    try:
+        local_ip = socket.gethostbyname(socket.gethostname())
+        if not local_ip.startswith("127."):
+            return local_ip
+    except OSError:
+        pass
+    return "127.0.0.1"
+
+def _recv_line(sock, maxlen=4096):
+    # Mensagem de controle entre peers: termina em "\n" (ou no EOF) e pode
+    # chegar em mais de um segmento TCP
+    buf = bytearray()
+    while len(buf) < maxlen:
+        chunk = sock.recv(maxlen - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+        if b"\n" in chunk:
+            break
+    return bytes(buf)
+
+class _FileCache:
+    # LRU de arquivos abertos para upload: pedidos seguidos do mesmo arquivo
+    # não repetem open()/stat(). Dividido em fatias, cada uma com seu lock,
+    # para uploads de arquivos diferentes não disputarem o mesmo lock. Um
+    # arquivo que sai do cache só é fechado quando nenhum envio em andamento
+    # ainda o usa
+
+    def __init__(self, shards=OPEN_FILE_CACHE_SHARDS, capacity_per_shard=OPEN_FILE_CACHE_SIZE):
+        self._capacity = capacity_per_shard
+        # caminho -> [arquivo, envios em andamento]
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+
+    @contextmanager
+    def open(self, path):
+        if not _HAS_SENDFILE:
+            # Envios simultâneos moveriam a posição um do outro: cada pedido
+            # abre o seu arquivo
+            with open(path, "rb") as f:
+                yield f
+            return
+        files, lock = self._shards[hash(path) % len(self._shards)]
+        with lock:
+            entry = files.get(path)
+            if entry is not None:
+                files.move_to_end(path)
+                entry[1] += 1
+        if entry is None:
+            # open() fora do lock; se outra thread abriu o mesmo caminho
+            # nesse meio tempo, fica a entrada dela
+            f = open(path, "rb")
+            with lock:
+                entry = files.get(path)
+                if entry is None:
+                    entry = files[path] = [f, 0]
+                    f = None
+                    if len(files) > self._capacity:
+                        _, old = files.popitem(last=False)
+                        if not old[1]:
+                            old[0].close()
+                entry[1] += 1
+            if f is not None:
+                f.close()
+        try:
+            yield entry[0]
+        finally:
+            with lock:
+                entry[1] -= 1
+                if not entry[1] and files.get(path) is not entry:
+                    entry[0].close()
+
+    def close(self):
+        # Tira tudo do cache; arquivos ainda em uso fecham no fim do envio
+        for files, lock in self._shards:
+            with lock:
+                for f, users in files.values():
+                    if not users:
+                        f.close()
+                files.clear()
+
+def _send_file_range(conn, f, offset, count):
+    # Envia count bytes de f a partir de offset; devolve quantos foram. Não
+    # usa socket.sendfile: se o sendfile(2) falha, ele cai em seek()+read()
+    # no próprio f, e f é dividido entre uploads pelo _FileCache
+    if not _HAS_SENDFILE:
+        # Aqui f é um arquivo só deste pedido (ver _FileCache.open)
+        return conn.sendfile(f, offset=offset, count=count)
+    sock_fd = conn.fileno()
+    file_fd = f.fileno()
+    sent = 0
+    sel = None
+    try:
+        while sent < count:
+            try:
+                n = os.sendfile(sock_fd, file_fd, offset + sent, count - sent)
+            except BlockingIOError:
+                # Socket com timeout é não bloqueante por baixo: espera
+                # espaço no buffer de envio
+                if sel is None:
+                    sel = selectors.DefaultSelector()
+                    sel.register(conn, selectors.EVENT_WRITE)
+                if not sel.select(conn.gettimeout()):
+                    raise socket.timeout("timed out")
+                continue
+            except OSError:
+                if sent:
+                    raise
+                # Arquivo ou socket sem suporte a sendfile(2): pread, que
+                # também não mexe na posição do arquivo
+                return _pread_file_range(conn, file_fd, offset, count)
+            if n == 0:
+                # O arquivo encolheu depois do fstat
+                break
+            sent += n
+    finally:
+        if sel is not None:
+            sel.close()
+    return sent
+
+def _pread_file_range(conn, fd, offset, count):
+    sent = 0
+    while sent < count:
+        data = os.pread(fd, min(DOWNLOAD_RECV_SIZE, count - sent), offset + sent)
+        if not data:
+            break
+        conn.sendall(data)
+        sent += len(data)
+    return sent
+
+def _set_low_latency(sock):
+    # Pedidos e respostas de controle são pequenos e vão e voltam na mesma
+    # conexão: sem Nagle, um pedido não espera o ACK (atrasado) da resposta
+    # anterior
+    if hasattr(socket, "TCP_NODELAY"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def _is_idle_conn_alive(sock):
+    # Conexão ociosa do pool: EOF (ou dado inesperado) significa que o
+    # outro peer já a fechou
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+def _file_batches(files, budget):
+    # Divide os nomes em listas cujo b",".join cabe em budget bytes; sempre
+    # devolve ao menos uma lista (vazia, se o peer não tem arquivos)
+    batch = []
+    size = -1
+    for fn in files:
+        if batch and size + 1 + len(fn) > budget:
+            yield batch
+            batch = []
+            size = -1
+        batch.append(fn)
+        size += 1 + len(fn)
+    yield batch
+
+@functools.lru_cache(maxsize=128)
+def _format_peer_id(pid_str):
+    upper = pid_str.upper()
+    if upper.startswith("PEER"):
+        return upper
+    else:
+        return f"PEER{pid_str}"
+
+_DIGITS = re.compile(r"\d+")
+
+@functools.lru_cache(maxsize=256)
+def _port_from_id(peer_id):
+    # Caso comum: "PEER<dígitos>", já normalizado por _format_peer_id
+    suffix = peer_id[4:]
+    if suffix.isdigit():
+        return 6000 + int(suffix)
+    numeric_part = ''.join(_DIGITS.findall(peer_id))
+    if numeric_part:
+        return 6000 + int(numeric_part)
+    else:
+        return 6000
 
 class Peer:
     
@@ -12,150 +276,349 @@ class Peer:
 
         self.ip = self.get_local_ip()  
         self.port = self.compute_port_from_id(self.peer_id)
-        self.files = files if files else []
+        self.files = list(files) if files else []
+        # Cópia em set para os pedidos de FILE_SIZE/DOWNLOAD; a lista mantém
+        # a ordem usada no REGISTER
+        self._files_set = set(self.files)
 
         print(f"[PEER-{self.peer_id}] IP local: {self.ip}, Porta local: {self.port}")
+
+        # Cliente do tracker em asyncio: um único loop, numa thread própria,
+        # atende o keepalive e os comandos do menu pela mesma conexão
+        self._loop = asyncio.new_event_loop()
+        self._reader = None
+        self._writer = None
+        self._connect_lock = asyncio.Lock()
+        # Pedidos em pipeline: cada um escreve na hora e lê sua resposta
+        # quando a leitura do pedido anterior termina (o tracker responde
+        # na ordem em que recebeu)
+        self._last_read = None
+        # Score acumulado ainda não enviado e a tarefa que vai enviá-lo
+        self._score_delta = 0
+        self._score_task = None
+        # close() acorda o keepalive na hora, sem esperar o intervalo
+        self._stop = asyncio.Event()
+        # Avisa o listener para sair; close() o acorda pelo _wake_w
+        self._closing = False
+        # Conexões que os workers devolvem ao listener, e o socket que o
+        # acorda para registrá-las (ou para sair, no close())
+        self._rearm = deque()
+        self._wake_w = None
+        self._listener = None
+
+        # (ip, porta) -> [(socket ocioso, instante da devolução)] para
+        # FILE_SIZE/DOWNLOAD; só é usado dentro do loop, então dispensa lock
+        self._peer_pools = {}
+
+        self._file_cache = _FileCache()
+
+        # (ip, porta, arquivo) -> (tamanho, instante da consulta)
+        self._size_cache = {}
+        self._size_cache_lock = threading.Lock()
+
+        # Pool fixo para as conexões recebidas, em vez de uma thread por accept
+        self._handler_pool = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="peer-handler")
+
+        # O peer_id não muda: os frames fixos são montados uma vez só
+        self._peer_id_wire = self.peer_id.encode()
+        self._keepalive_wire = protocol.encode_frame(protocol.OP_KEEPALIVE, self._peer_id_wire)
+        self._unregister_wire = protocol.encode_frame(protocol.OP_UNREGISTER, self._peer_id_wire)
+        self._increment_prefix = b"INCREMENT_SCORE %s " % self._peer_id_wire
         
-        # Inicia thread para o keepalive
-        self.keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
-        self.keepalive_thread.start()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        # O keepalive é uma tarefa do loop, não uma thread
+        self._keepalive = asyncio.run_coroutine_threadsafe(self._keepalive_loop(), self._loop)
 
     def format_peer_id(self, pid_str):
-        if pid_str.upper().startswith("PEER"):
-            return pid_str.upper()
-        else:
-            return f"PEER{pid_str}"
+        return _format_peer_id(pid_str)
 
     def compute_port_from_id(self, peer_id):
-        numeric_part = ''.join(filter(str.isdigit, peer_id))
-        if numeric_part:
-            return 6000 + int(numeric_part)
-        else:
-            return 6000
+        return _port_from_id(peer_id)
 
     def get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-        finally:
-            s.close()
-        return local_ip
+        return get_local_ip()
 
-    def _keepalive_loop(self, interval=30):
+    def invalidate_ip_cache(self):
+        # O IP fica em cache no processo; após trocar de rede, limpa e relê
+        get_local_ip.cache_clear()
+        self.ip = get_local_ip()
+
+    async def _keepalive_loop(self, interval=30):
         while True:
-            time.sleep(interval)
-            self.send_keepalive()
+            try:
+                await asyncio.wait_for(self._stop.wait(), interval)
+                return
+            except asyncio.TimeoutError:
+                await self._tracker_request(self._keepalive_wire)
 
     def send_keepalive(self):
-        msg = f"KEEPALIVE {self.peer_id}"
-        resp = self._send_msg_to_tracker(msg)
-        # print("[PEER] Resposta KEEPALIVE:", resp)
+        resp = self._send_frame_to_tracker(self._keepalive_wire)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[PEER] Resposta KEEPALIVE: %s", resp.decode().strip())
 
     def register(self):
         print(f"[PEER] Registrando com arquivos: {self.files}")
-        msg = f"REGISTER {self.peer_id} {self.ip} {self.port}"
-        if self.files:
-            files_str = ",".join(self.files)
-            msg += f" {files_str}"
-        resp = self._send_msg_to_tracker(msg)
-        print("[PEER] Resposta REGISTER:", resp)
+        files = [fn.encode() for fn in self.files]
+        try:
+            socket.inet_aton(self.ip)
+            text_head = None
+            budget = protocol.MAX_PAYLOAD - protocol.REGISTER_HEAD.size - len(self._peer_id_wire)
+        except OSError:
+            # IP não-IPv4 não cabe no frame de REGISTER: vai o comando em texto
+            text_head = b" ".join([b"REGISTER", self._peer_id_wire, self.ip.encode(), b"%d" % self.port])
+            budget = protocol.MAX_PAYLOAD - len(text_head) - 1
+        # Lista de arquivos maior que um frame: vários REGISTER, e o tracker
+        # junta os arquivos de cada um aos que o peer já tinha
+        for batch in _file_batches(files, budget):
+            if text_head is None:
+                resp = self._send_frame_to_tracker(protocol.encode_register(self._peer_id_wire, self.ip, self.port, batch))
+            else:
+                resp = self._send_msg_to_tracker(b" ".join([text_head, b",".join(batch)]) if batch else text_head)
+            if resp != b"REGISTER_OK\n":
+                break
+        print("[PEER] Resposta REGISTER:", resp.decode().strip())
 
     def unregister(self):
-        msg = f"UNREGISTER {self.peer_id}"
-        resp = self._send_msg_to_tracker(msg)
-        print("[PEER] Resposta UNREGISTER:", resp)
+        # Score pendente vai antes de o peer sair do tracker
+        asyncio.run_coroutine_threadsafe(self._flush_score(), self._loop).result()
+        resp = self._send_frame_to_tracker(self._unregister_wire)
+        print("[PEER] Resposta UNREGISTER:", resp.decode().strip())
+
+    def close(self):
+        # Encerra o peer: primeiro para de aceitar pedidos e espera os
+        # uploads em andamento (eles ainda somam score no loop); depois
+        # envia o score, fecha as conexões e para o loop
+        self._closing = True
+        if self._listener is not None:
+            self._wake_listener()
+            self._listener.join()
+        self._handler_pool.shutdown(wait=True)
+        # Conexões devolvidas por workers depois que o listener saiu
+        while self._rearm:
+            self._rearm.popleft()[0].close()
+        if self._wake_w is not None:
+            self._wake_w.close()
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._keepalive.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._file_cache.close()
+
+    async def _shutdown(self):
+        self._stop.set()
+        await self._flush_score()
+        self._close_tracker_conn(self._writer)
+        for pool in self._peer_pools.values():
+            for sock, _ in pool:
+                sock.close()
+        self._peer_pools.clear()
 
     def search(self, filename):
-        msg = f"SEARCH {filename}"
-        resp = self._send_msg_to_tracker(msg)
+        frame = protocol.encode_frame(protocol.OP_SEARCH, filename.encode())
+        resp = self._send_frame_to_tracker(frame)
         if not resp:
             print("[PEER] Erro: Resposta vazia do tracker.")
             return
-        lines = resp.splitlines()
-        if lines[0].startswith("SEARCH_RESULT"):
-            num = int(lines[0].split()[1])
+        # A resposta fica em bytes; só as linhas exibidas são decodificadas
+        first, _, rest = resp.partition(b"\n")
+        if first.startswith(_SEARCH_RESULT):
+            num = int(first[len(_SEARCH_RESULT):])
             if num == 0:
                 print(f"[PEER] Nenhum peer possui '{filename}'.")
             else:
                 print(f"[PEER] {num} peer(s) possuem '{filename}':")
-                for line in lines[1:]:
-                    print("  ", line)
+                for line in rest.splitlines():
+                    print("  ", line.decode())
         else:
-            print("[PEER] Resposta inesperada:", resp)
+            print("[PEER] Resposta inesperada:", resp.decode(errors="replace"))
 
-    def get_peers(self):
-        msg = "GET_PEERS"
+    def search_many(self, filenames):
+        # Busca vários arquivos com uma única ida e volta ao tracker
+        msg = b" ".join([b"SEARCH_MANY"] + [fn.encode() for fn in filenames])
+        if len(msg) > protocol.MAX_PAYLOAD:
+            print(f"[PEER] Erro: SEARCH_MANY passa do limite de {protocol.MAX_PAYLOAD} bytes; divida a busca.")
+            return
         resp = self._send_msg_to_tracker(msg)
         if not resp:
             print("[PEER] Erro: Resposta vazia do tracker.")
             return
-        lines = resp.splitlines()
-        if lines[0].startswith("PEER_LIST"):
+        first, _, rest = resp.partition(b"\n")
+        if not first.startswith(_SEARCH_MANY_RESULT):
+            print("[PEER] Resposta inesperada:", resp.decode(errors="replace"))
+            return
+        lines = rest.splitlines()
+        i = 0
+        for _ in range(int(first[len(_SEARCH_MANY_RESULT):])):
+            filename, num = lines[i].rsplit(b" ", 1)
+            filename = filename.decode()
+            num = int(num)
+            if num == 0:
+                print(f"[PEER] Nenhum peer possui '{filename}'.")
+            else:
+                print(f"[PEER] {num} peer(s) possuem '{filename}':")
+                for line in lines[i + 1:i + 1 + num]:
+                    print("  ", line.decode())
+            i += 1 + num
+
+    def get_peers(self):
+        resp = self._send_frame_to_tracker(protocol.encode_frame(protocol.OP_GET_PEERS))
+        if not resp:
+            print("[PEER] Erro: Resposta vazia do tracker.")
+            return
+        first, _, rest = resp.partition(b"\n")
+        if first.startswith(_PEER_LIST):
             print(f"[PEER] Peers registrados:")
-            for line in lines[1:]:
-                print("  ", line)
+            for line in rest.splitlines():
+                print("  ", line.decode())
         else:
-            print("[PEER] Resposta inesperada:", resp)
+            print("[PEER] Resposta inesperada:", resp.decode(errors="replace"))
 
     def start_lister(self):
         """Inicia um servidor para receber mensagens de outros peers (chat ou pedidos de arquivo)."""
-        listener = threading.Thread(target=self._listen_for_messages, daemon=True)
-        listener.start()
+        # O par de sockets existe antes da thread: close() consegue acordar
+        # o listener mesmo que ele ainda não tenha chegado ao select
+        wake_r, self._wake_w = socket.socketpair()
+        wake_r.setblocking(False)
+        self._listener = threading.Thread(target=self._listen_for_messages, args=(wake_r,), daemon=True)
+        self._listener.start()
+
+    def _wake_listener(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
 
-    def _listen_for_messages(self):
+    def _listen_for_messages(self, wake_r):
         server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.bind((self.ip, self.port))
-        server_sock.listen(5)
+        try:
+            server_sock.bind((self.ip, self.port))
+        except OSError:
+            # Porta ocupada (outro peer com o mesmo ID nesta máquina)
+            server_sock.close()
+            wake_r.close()
+            raise
+        # Cada download abre várias conexões de uma vez; com fila curta os
+        # SYNs excedentes só entram depois da retransmissão (~1 s)
+        server_sock.listen(128)
+        server_sock.setblocking(False)
         print(f"[PEER-{self.peer_id}] Escutando mensagens em {self.ip}:{self.port}")
 
-        while True:
-            conn, addr = server_sock.accept()
-            threading.Thread(target=self._handle_peer_message, args=(conn, addr)).start()
+        # O selector espera pelo próximo pedido de cada conexão; só um pedido
+        # que chegou vai para o pool. Conexões ociosas do pool de quem baixa
+        # não seguram worker nenhum
+        sel = selectors.DefaultSelector()
+        sel.register(server_sock, selectors.EVENT_READ, None)
+        sel.register(wake_r, selectors.EVENT_READ, wake_r)
+        # conexão -> instante em que ela é fechada se continuar ociosa
+        idle = {}
+        monotonic = time.monotonic
+        try:
+            while not self._closing:
+                events = sel.select(timeout=1.0)
+                now = monotonic()
+                for key, _ in events:
+                    if key.data is None:
+                        try:
+                            conn, addr = server_sock.accept()
+                        except OSError:
+                            # Nada na fila, ou conexão desfeita antes do accept
+                            continue
+                        conn.settimeout(PEER_CONN_TIMEOUT)
+                        _set_low_latency(conn)
+                        sel.register(conn, selectors.EVENT_READ, addr)
+                        idle[conn] = now + PEER_IDLE_TIMEOUT
+                    elif key.data is wake_r:
+                        try:
+                            wake_r.recv(4096)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        conn = key.fileobj
+                        sel.unregister(conn)
+                        del idle[conn]
+                        self._handler_pool.submit(self._handle_peer_message, conn, key.data)
+                # Conexões devolvidas pelos workers depois de responder
+                while self._rearm:
+                    conn, addr = self._rearm.popleft()
+                    sel.register(conn, selectors.EVENT_READ, addr)
+                    idle[conn] = now + PEER_IDLE_TIMEOUT
+                for conn in [c for c, deadline in idle.items() if deadline <= now]:
+                    sel.unregister(conn)
+                    del idle[conn]
+                    conn.close()
+        finally:
+            for conn in idle:
+                conn.close()
+            while self._rearm:
+                self._rearm.popleft()[0].close()
+            sel.close()
+            wake_r.close()
+            server_sock.close()
 
     def _handle_peer_message(self, conn, addr):
+        # Um pedido por vez: respondido, a conexão volta ao selector do
+        # listener em vez de prender a thread esperando o próximo pedido
+        keep = False
         try:
-            msg = conn.recv(4096).decode().strip()
-            if not msg:
-                return
-
-            parts = msg.split()
-            cmd = parts[0].upper()
-
-            if cmd == "CHAT":
-                # Formato: CHAT <mensagem>
-                mensagem = " ".join(parts[1:])
-                print(f"[CHAT] Mensagem recebida de {addr}: {mensagem}")
-
-            elif cmd == "FILE_SIZE":
-                # FILE_SIZE <filename>
-                if len(parts) == 2:
-                    filename = parts[1]
-                    self._handle_file_size_request(conn, filename)
-                else:
-                    conn.sendall(b"ERROR Uso: FILE_SIZE <filename>\n")
-
-            elif cmd == "DOWNLOAD":
-                # DOWNLOAD <filename> <start> <end>
-                if len(parts) == 4:
-                    filename = parts[1]
-                    start = int(parts[2])
-                    end = int(parts[3])
-                    self._handle_file_download_request(conn, filename, start, end)
-                else:
-                    conn.sendall(b"ERROR Uso: DOWNLOAD <filename> <start> <end>\n")
-
-            else:
-                print(f"[CHAT] Mensagem (desconhecida) de {addr}: {msg}")
-
+            keep = self._handle_one_message(conn, addr)
+        except socket.timeout:
+            pass
         finally:
-            conn.close()
+            if keep:
+                self._rearm.append((conn, addr))
+                self._wake_listener()
+            else:
+                conn.close()
+
+    def _handle_one_message(self, conn, addr):
+        # Devolve False quando a conexão deve ser fechada
+        msg = _recv_line(conn).strip()
+        if not msg:
+            return False
+
+        cmd, _, rest = msg.partition(b" ")
+        handler = self._PEER_HANDLERS.get(cmd.upper())
+        if handler is None:
+            print(f"[CHAT] Mensagem (desconhecida) de {addr}: {msg.decode(errors='replace')}")
+            return True
+        return handler(self, conn, addr, rest)
+
+    def _handle_chat(self, conn, addr, rest):
+        # Formato: CHAT <mensagem>
+        mensagem = " ".join(rest.decode().split())
+        print(f"[CHAT] Mensagem recebida de {addr}: {mensagem}")
+        return True
+
+    def _handle_file_size(self, conn, addr, rest):
+        # FILE_SIZE <filename>
+        args = rest.split()
+        if len(args) == 1:
+            self._handle_file_size_request(conn, args[0].decode())
+        else:
+            conn.sendall(b"ERROR Uso: FILE_SIZE <filename>\n")
+        return True
+
+    def _handle_download(self, conn, addr, rest):
+        # DOWNLOAD <filename> <start> <end>
+        args = rest.split()
+        if len(args) == 3:
+            return self._handle_file_download_request(conn, args[0].decode(), int(args[1]), int(args[2]))
+        conn.sendall(b"ERROR Uso: DOWNLOAD <filename> <start> <end>\n")
+        return False
+
+    _PEER_HANDLERS = {
+        b"CHAT": _handle_chat,
+        b"FILE_SIZE": _handle_file_size,
+        b"DOWNLOAD": _handle_download
+    }
 
     def send_message(self, target_ip, target_port, message):
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                 sock.connect((target_ip, target_port))
-                cmd_msg = f"CHAT {message}"
+                cmd_msg = f"CHAT {message}\n"
                 sock.sendall(cmd_msg.encode())
                 print(f"[CHAT] Mensagem enviada para {target_ip}:{target_port}: {message}")
         except Exception as e:
@@ -176,133 +639,337 @@ class Peer:
         # Nome do arquivo para salvar localmente
         local_filename = os.path.join(download_dir, filename)
 
-        # Cria o arquivo com o tamanho correto
-        with open(local_filename, "wb") as f:
+        # Cria o arquivo com o tamanho correto e o mapeia em memória: cada
+        # chunk é recebido direto na sua faixa do arquivo
+        with open(local_filename, "wb+") as f:
             f.truncate(file_size)
+            mm = mmap.mmap(f.fileno(), file_size)
 
         chunk_size = file_size // num_connections
-        threads = []
+        ranges = []
         for i in range(num_connections):
             start = i * chunk_size
             end = file_size if i == num_connections - 1 else (start + chunk_size)
-            t = threading.Thread(
-                target=self._download_chunk,
-                args=(target_ip, target_port, filename, start, end, local_filename, i)
-            )
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            t.join()
+            ranges.append((start, end))
+
+        # Os chunks rodam juntos no loop do peer, sem uma thread por conexão
+        future = asyncio.run_coroutine_threadsafe(
+            self._download_chunks(target_ip, target_port, filename, ranges, mm), self._loop)
+        ok = future.result()
+        mm.close()
+
+        if not ok:
+            # Arquivo incompleto não é compartilhado; o tamanho em cache
+            # pode estar desatualizado, então a próxima tentativa consulta de novo
+            with self._size_cache_lock:
+                self._size_cache.pop((target_ip, target_port, filename), None)
+            os.remove(local_filename)
+            print(f"[DOWNLOAD] Download de '{filename}' falhou: arquivo incompleto descartado.")
+            return
 
         print(f"[DOWNLOAD] Download de '{filename}' concluído. Salvo em '{local_filename}'.")
 
-        if filename not in self.files:
-            self.files.append(filename)
+        if self._add_file(filename):
             print(f"[DOWNLOAD] Arquivo '{filename}' adicionado à lista de arquivos compartilhados.")
             self.register()
 
-    def _download_chunk(self, target_ip, target_port, filename, start, end, local_filename, idx):
+    def _add_file(self, filename):
+        if filename in self._files_set:
+            return False
+        self.files.append(filename)
+        self._files_set.add(filename)
+        return True
+
+    async def _download_chunks(self, target_ip, target_port, filename, ranges, mm):
+        # True só se todos os chunks chegaram inteiros
+        results = await asyncio.gather(*[
+            self._download_chunk(target_ip, target_port, filename, start, end, mm, idx)
+            for idx, (start, end) in enumerate(ranges)
+        ])
+        return all(results)
+
+    async def _download_chunk(self, target_ip, target_port, filename, start, end, mm, idx):
+        loop = self._loop
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect((target_ip, target_port))
-                cmd = f"DOWNLOAD {filename} {start} {end}"
-                sock.sendall(cmd.encode())
-
-                total_bytes = end - start
-                received = 0
-                data_chunks = []
-                while received < total_bytes:
-                    chunk = sock.recv(min(4096, total_bytes - received))
-                    if not chunk:
-                        break
-                    data_chunks.append(chunk)
-                    received += len(chunk)
-
-            with open(local_filename, "rb+") as f:
-                f.seek(start)
-                f.write(b"".join(data_chunks))
-
-            print(f"[DOWNLOAD] Chunk #{idx} (bytes {start}-{end}) baixado com sucesso.")
+            sock = await self._acquire_conn(target_ip, target_port)
+            total_bytes = end - start
+            received = 0
+            try:
+                with memoryview(mm)[start:end] as view:
+                    cmd = f"DOWNLOAD {filename} {start} {end}\n"
+                    await loop.sock_sendall(sock, cmd.encode())
+
+                    # sock_recv_into escreve direto na faixa do mmap
+                    while received < total_bytes:
+                        n = await loop.sock_recv_into(sock, view[received:received + DOWNLOAD_RECV_SIZE])
+                        if not n:
+                            break
+                        received += n
+            finally:
+                # Só volta ao pool se a resposta veio inteira
+                if received == total_bytes:
+                    self._release_conn(target_ip, target_port, sock)
+                else:
+                    sock.close()
+
+            if received != total_bytes:
+                print(f"[DOWNLOAD] Chunk #{idx} do arquivo '{filename}' incompleto: {received} de {total_bytes} bytes.")
+                return False
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[DOWNLOAD] Chunk #%d (bytes %d-%d) baixado com sucesso.", idx, start, end)
+            return True
         except Exception as e:
             print(f"[DOWNLOAD] Erro ao baixar chunk #{idx} do arquivo '{filename}': {e}")
+            return False
 
     def _get_file_size(self, target_ip, target_port, filename):
+        key = (target_ip, target_port, filename)
+        with self._size_cache_lock:
+            cached = self._size_cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] < FILE_SIZE_TTL:
+            return cached[0]
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect((target_ip, target_port))
-                cmd = f"FILE_SIZE {filename}"
-                sock.sendall(cmd.encode())
-                resp = sock.recv(1024).decode().strip()
-                if resp.startswith("FILE_SIZE_OK"):
-                    parts = resp.split()
-                    size = int(parts[1])
-                    return size
-                else:
-                    print("[DOWNLOAD] Resposta inesperada ao FILE_SIZE:", resp)
-                    return -1
+            future = asyncio.run_coroutine_threadsafe(
+                self._file_size_request(target_ip, target_port, filename), self._loop)
+            resp = future.result()
+            if resp.startswith("FILE_SIZE_OK"):
+                parts = resp.split()
+                size = int(parts[1])
+                with self._size_cache_lock:
+                    self._size_cache[key] = (size, time.monotonic())
+                return size
+            else:
+                with self._size_cache_lock:
+                    self._size_cache.pop(key, None)
+                print("[DOWNLOAD] Resposta inesperada ao FILE_SIZE:", resp)
+                return -1
         except Exception as e:
             print(f"[DOWNLOAD] Erro ao obter FILE_SIZE: {e}")
             return -1
 
+    async def _file_size_request(self, target_ip, target_port, filename):
+        sock = await self._acquire_conn(target_ip, target_port)
+        try:
+            await self._loop.sock_sendall(sock, f"FILE_SIZE {filename}\n".encode())
+            resp = await self._recv_line_async(sock)
+        except BaseException:
+            sock.close()
+            raise
+        resp = resp.decode().strip()
+        if resp.startswith("FILE_SIZE_OK"):
+            self._release_conn(target_ip, target_port, sock)
+        else:
+            sock.close()
+        return resp
+
+    async def _recv_line_async(self, sock, maxlen=4096):
+        # Como _recv_line, para os sockets não bloqueantes do loop. Não lê
+        # além da linha porque o outro peer só responde depois do pedido
+        buf = bytearray()
+        while len(buf) < maxlen:
+            chunk = await self._loop.sock_recv(sock, maxlen - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+            if b"\n" in chunk:
+                break
+        return bytes(buf)
+
+    async def _acquire_conn(self, target_ip, target_port):
+        pool = self._peer_pools.get((target_ip, target_port))
+        now = time.monotonic()
+        while pool:
+            sock, released = pool.pop()
+            if now - released < PEER_POOL_IDLE and _is_idle_conn_alive(sock):
+                return sock
+            sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Antes do connect, para a janela TCP ser negociada com ele
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TRANSFER_SOCKET_BUFFER)
+        sock.setblocking(False)
+        try:
+            await self._loop.sock_connect(sock, (target_ip, target_port))
+        except BaseException:
+            sock.close()
+            raise
+        _set_low_latency(sock)
+        return sock
+
+    def _release_conn(self, target_ip, target_port, sock):
+        pool = self._peer_pools.setdefault((target_ip, target_port), [])
+        if len(pool) < PEER_POOL_SIZE:
+            pool.append((sock, time.monotonic()))
+        else:
+            sock.close()
+
     def _handle_file_size_request(self, conn, filename):
         # Procura o arquivo na pasta atual ou na pasta 'downloads'
         file_path = None
-        if filename in self.files:
+        if filename in self._files_set:
             if os.path.exists(filename):
                 file_path = filename
             elif os.path.exists(os.path.join("downloads", filename)):
                 file_path = os.path.join("downloads", filename)
 
         if file_path:
-            size = os.path.getsize(file_path)
+            with self._file_cache.open(file_path) as f:
+                size = os.fstat(f.fileno()).st_size
             resp = f"FILE_SIZE_OK {size}\n"
             conn.sendall(resp.encode())
         else:
             conn.sendall(b"ERROR FILE NOT FOUND\n")
 
     def _handle_file_download_request(self, conn, filename, start, end):
+        # Devolve True só se enviou exatamente a faixa pedida; senão o outro
+        # lado não tem como saber onde a resposta termina e a conexão fecha
+        requested = end - start
         # Procura o arquivo na pasta atual ou na pasta 'downloads'
         file_path = None
-        if filename in self.files:
+        if filename in self._files_set:
             if os.path.exists(filename):
                 file_path = filename
             elif os.path.exists(os.path.join("downloads", filename)):
                 file_path = os.path.join("downloads", filename)
 
         if file_path:
-            file_size = os.path.getsize(file_path)
-            if start < 0:
-                start = 0
-            if end > file_size:
-                end = file_size
-
-            length = end - start
-            if length <= 0:
-                conn.sendall(b"")
-                return
-
-            with open(file_path, "rb") as f:
-                f.seek(start)
-                data = f.read(length)
-            conn.sendall(data)
+            with self._file_cache.open(file_path) as f:
+                file_size = os.fstat(f.fileno()).st_size
+                if start < 0:
+                    start = 0
+                if end > file_size:
+                    end = file_size
+
+                length = end - start
+                if length <= 0:
+                    return False
+
+                # sendfile(2): do page cache direto para o socket, sem passar
+                # por um bytes em Python
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, TRANSFER_SOCKET_BUFFER)
+                sent = _send_file_range(conn, f, start, length)
 
             self._increment_score(length)
+            return sent == requested
         else:
             conn.sendall(b"ERROR FILE NOT FOUND\n")
+            return False
 
     def _increment_score(self, delta):
-        msg = f"INCREMENT_SCORE {self.peer_id} {delta}"
-        _ = self._send_msg_to_tracker(msg)
-
-    def _send_msg_to_tracker(self, msg):
+        # Chamado a cada chunk servido: só acumula no loop, sem esperar o
+        # tracker; o total sai num único INCREMENT_SCORE por intervalo
+        self._loop.call_soon_threadsafe(self._add_score, delta)
+
+    def _add_score(self, delta):
+        self._score_delta += delta
+        if self._score_task is None:
+            self._score_task = self._loop.create_task(self._flush_score_later())
+
+    async def _flush_score_later(self):
+        await asyncio.sleep(SCORE_FLUSH_INTERVAL)
+        # Só esta tarefa limpa a referência a si mesma; um chunk servido
+        # durante o envio já agenda a próxima
+        self._score_task = None
+        await self._send_score()
+
+    async def _flush_score(self):
+        # Envio imediato (unregister, close): a tarefa agendada não teria
+        # mais o que enviar e não pode sobrar depois do close()
+        if self._score_task is not None:
+            self._score_task.cancel()
+            self._score_task = None
+        await self._send_score()
+
+    async def _send_score(self):
+        delta, self._score_delta = self._score_delta, 0
+        if delta:
+            msg = self._increment_prefix + b"%d" % delta
+            await self._tracker_request(protocol.encode_frame(protocol.OP_TEXT, msg))
+
+    async def _connect_tracker(self):
+        sock = self._connect_tracker_unix()
+        if sock is not None:
+            self._reader, self._writer = await asyncio.open_unix_connection(sock=sock)
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if hasattr(socket, "TCP_NODELAY"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TRACKER_RCVBUF)
+        sock.setblocking(False)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.tracker_ip, self.tracker_port))
-            sock.sendall((msg + "\n").encode())
-            resp = sock.recv(4096).decode()
+            await self._loop.sock_connect(sock, (self.tracker_ip, self.tracker_port))
+        except OSError:
             sock.close()
-            return resp.strip()
-        except Exception as e:
-            print(f"[PEER] Erro ao comunicar com tracker: {e}")
-            return ""
+            raise
+        self._reader, self._writer = await asyncio.open_connection(sock=sock)
+
+    def _connect_tracker_unix(self):
+        # Tracker na mesma máquina: usa o socket AF_UNIX se ele existir
+        if not hasattr(socket, "AF_UNIX") or self.tracker_ip not in ("127.0.0.1", "localhost", self.ip):
+            return None
+        path = protocol.unix_socket_path(self.tracker_port)
+        if path is None or not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TRACKER_RCVBUF)
+        return sock
+
+    def _close_tracker_conn(self, writer):
+        # Só fecha se ainda for a conexão atual: outro pedido pode já ter
+        # reconectado
+        if writer is not None and writer is self._writer:
+            writer.close()
+            self._reader = None
+            self._writer = None
+
+    async def _read_framed_response(self, reader):
+        # Resposta a um frame: prefixo de tamanho e o corpo lido de uma vez,
+        # sem procurar "\n" linha a linha
+        header = await reader.readexactly(protocol.RESPONSE_HEADER.size)
+        (size,) = protocol.RESPONSE_HEADER.unpack(header)
+        return await reader.readexactly(size)
+
+    def _send_msg_to_tracker(self, msg):
+        # Comando em texto vai num frame OP_TEXT (até protocol.MAX_PAYLOAD
+        # bytes, o mesmo limite de linha do tracker)
+        return self._send_frame_to_tracker(protocol.encode_frame(protocol.OP_TEXT, msg))
+
+    def _send_frame_to_tracker(self, frame):
+        # Chamado pelas threads do menu/downloads: roda o pedido no loop e espera
+        future = asyncio.run_coroutine_threadsafe(self._tracker_request(frame), self._loop)
+        return future.result()
+
+    async def _tracker_request(self, frame):
+        # frame já vem pronto, com cabeçalho e payload
+        for attempt in range(2):
+            writer = None
+            try:
+                if self._writer is None or self._writer.is_closing():
+                    async with self._connect_lock:
+                        if self._writer is None or self._writer.is_closing():
+                            await self._connect_tracker()
+                reader, writer = self._reader, self._writer
+                # Entre pegar a vez e o write não há await: a ordem dos
+                # pedidos no socket é a mesma da fila de leitura
+                prev = self._last_read
+                done = self._loop.create_future()
+                self._last_read = done
+                writer.write(frame)
+                try:
+                    await writer.drain()
+                    if prev is not None:
+                        await prev
+                    return await self._read_framed_response(reader)
+                finally:
+                    done.set_result(None)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                # Conexão caiu (ou o tracker reiniciou): reconecta uma vez
+                self._close_tracker_conn(writer)
+                if attempt:
+                    print(f"[PEER] Erro ao comunicar com tracker: {e}")
+        return b""
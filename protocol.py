@@ -0,0 +1,93 @@
+import os
+import socket
+import stat
+import struct
+import tempfile
+
+# Protocolo binário entre peer e tracker. Cada frame é
+#   !BH  (opcode, tamanho do payload) + payload
+# Os opcodes ficam abaixo de 0x20, então o tracker distingue um frame
+# binário de um comando em texto ("REGISTER ...\n") pelo primeiro byte.
+# A resposta a um frame vem com prefixo de tamanho (!I) + corpo em texto;
+# comandos em texto puro continuam recebendo só o texto.
+
+OP_REGISTER = 1
+OP_UNREGISTER = 2
+OP_SEARCH = 3
+OP_GET_PEERS = 4
+OP_KEEPALIVE = 5
+# Comando em texto qualquer dentro de um frame, para receber a resposta
+# com prefixo de tamanho
+OP_TEXT = 6
+
+OP_NAMES = {
+    OP_REGISTER: b"REGISTER",
+    OP_UNREGISTER: b"UNREGISTER",
+    OP_SEARCH: b"SEARCH",
+    OP_GET_PEERS: b"GET_PEERS",
+    OP_KEEPALIVE: b"KEEPALIVE",
+    OP_TEXT: b"TEXT"
+}
+
+HEADER = struct.Struct("!BH")
+MAX_PAYLOAD = 0xFFFF
+RESPONSE_HEADER = struct.Struct("!I")
+# Payload do REGISTER: (tamanho do peer_id, IPv4, porta) + peer_id + arquivos
+REGISTER_HEAD = struct.Struct("!B4sH")
+
+def _private_dir():
+    # Diretório só do usuário atual (XDG_RUNTIME_DIR ou um 0700 no tmp): outro
+    # usuário não consegue criar o socket antes do tracker e se passar por ele
+    if not hasattr(os, "getuid"):
+        return None
+    path = os.environ.get("XDG_RUNTIME_DIR")
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), f"tracker-{os.getuid()}")
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None
+    return path
+
+def unix_socket_path(port):
+    # Tracker e peers na mesma máquina conversam por AF_UNIX neste caminho;
+    # None se não há diretório privado seguro (usa-se só TCP)
+    directory = _private_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, f"tracker-{port}.sock")
+
+def encode_frame(op, payload=b""):
+    return HEADER.pack(op, len(payload)) + payload
+
+def encode_register(peer_id, ip, port, files):
+    # Levanta OSError para IP que não é IPv4 e struct.error se não couber no
+    # frame; o peer usa o comando em texto no primeiro caso e divide a lista
+    # de arquivos em vários REGISTER no segundo
+    head = REGISTER_HEAD.pack(len(peer_id), socket.inet_aton(ip), port)
+    return encode_frame(OP_REGISTER, head + peer_id + b",".join(files))
+
+def decode_frame(op, payload):
+    # Devolve os mesmos campos que o split() de um comando em texto
+    if op == OP_REGISTER:
+        pid_len, ip, port = REGISTER_HEAD.unpack_from(payload)
+        start = REGISTER_HEAD.size
+        peer_id = payload[start:start + pid_len]
+        parts = [b"REGISTER", peer_id, socket.inet_ntoa(ip).encode(), b"%d" % port]
+        files = payload[start + pid_len:]
+        if files:
+            parts.append(files)
+        return parts
+    if op == OP_GET_PEERS:
+        return [b"GET_PEERS"]
+    if op == OP_TEXT:
+        return payload.split()
+    return [OP_NAMES[op], payload]
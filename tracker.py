@@ -1,167 +1,788 @@
+import asyncio
 import socket
 import threading
 import time
 import sys
+import os
+import heapq
+import queue
+import itertools
+import multiprocessing
+import selectors
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+
+import protocol
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Buffers do kernel nos sockets do tracker (herdados pelos sockets aceitos)
+SOCKET_BUFFER_SIZE = 256 * 1024
+# Fila de conexões pendentes; o kernel limita ao net.core.somaxconn
+LISTEN_BACKLOG = 1024
+# Buffer de leitura reaproveitado pelo loop do selector
+RECV_BUFFER_SIZE = 8192
+# Máximo de buffers por sendmsg (IOV_MAX no Linux)
+SENDMSG_MAX_BUFFERS = 1024
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+# Máximo de linhas de log escritas de uma vez pela thread de log
+LOG_BATCH = 256
+# Conexões simultâneas atendidas pelo reator. Acima disso a conexão só
+# recebe ERROR BUSY, no formato do primeiro pedido, e é fechada; passando
+# também de REFUSE_BACKLOG recusas pendentes, é fechada direto no accept
+MAX_CONNECTIONS = 10000
+REFUSE_BACKLOG = 1024
+# Comando em texto sem "\n" maior que isto fecha a conexão (os frames já são
+# limitados pelo campo de tamanho do cabeçalho)
+MAX_LINE_SIZE = protocol.MAX_PAYLOAD
+# Respostas ainda não enviadas acima disto: o reator para de ler comandos
+# da conexão até o cliente consumir a fila
+OUT_HIGH_WATER = 4 * 1024 * 1024
+# Número de fatias da tabela de peers (potência de 2, escolhida por máscara)
+N_SHARDS = 16
+
+# Cabeçalhos do SEARCH para os tamanhos de resultado mais comuns; as demais
+# respostas fixas já são literais bytes, constantes do próprio código
+_SEARCH_RESULT_N = [b"SEARCH_RESULT %d\n" % n for n in range(256)]
+
+def _peer_line(peer_id, info):
+    files = b", ".join([b"'%s'" % fn for fn in sorted(info.files)])
+    return b"%s %s %d [%s] Score=%d\n" % (peer_id, info.ip, info.port, files, info.score)
+
+def _names(file_list):
+    # Só para os logs: nomes de arquivo em bytes -> lista de str
+    return [fn.decode(errors="replace") for fn in file_list]
+
+@dataclass(slots=True)
+class PeerInfo:
+    # Estado de um peer registrado; slots evitam um dict por peer.
+    # ip e files guardam bytes, do jeito que chegam do socket
+    ip: bytes
+    port: int
+    files: frozenset
+    last_keepalive: float
+    # Timestamp da entrada deste peer no heap de expiração
+    expiry: float
+    score: int = 0
+
+@dataclass(slots=True)
+class PeerShard:
+    # Uma fatia da tabela de peers, com lock e índice reverso próprios:
+    # peers em fatias diferentes não disputam o mesmo lock
+    peers: dict = field(default_factory=dict)
+    # Índice reverso arquivo -> peer_ids, para o SEARCH não varrer todos os peers
+    file_index: defaultdict = field(default_factory=lambda: defaultdict(set))
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Linhas do PEER_LIST já serializadas, refeitas quando files ou score
+    # mudam. O GET_PEERS só copia a lista; line_idx e line_pids permitem
+    # remover uma linha em O(1) trocando-a pela última
+    lines: list = field(default_factory=list)
+    line_pids: list = field(default_factory=list)
+    line_idx: dict = field(default_factory=dict)
+
+    def set_line(self, peer_id, line):
+        idx = self.line_idx.get(peer_id)
+        if idx is None:
+            self.line_idx[peer_id] = len(self.lines)
+            self.lines.append(line)
+            self.line_pids.append(peer_id)
+        else:
+            self.lines[idx] = line
+
+    def drop_line(self, peer_id):
+        idx = self.line_idx.pop(peer_id)
+        last = self.lines.pop()
+        last_pid = self.line_pids.pop()
+        if idx != len(self.lines):
+            self.lines[idx] = last
+            self.line_pids[idx] = last_pid
+            self.line_idx[last_pid] = idx
+
+_LINE_TOO_LONG = b"ERROR Comando longo demais\n"
+_BUSY = b"ERROR BUSY\n"
 
 class Tracker:
 
-    def __init__(self, host="0.0.0.0", port=5000):
+    def __init__(self, host="0.0.0.0", port=5000, verbose=True, max_connections=MAX_CONNECTIONS, reuse_port=False):
         self.host = host
         self.port = port
-        self.peers = {}
-        self.lock = threading.Lock()
+        self.max_connections = max_connections
+        # SO_REUSEPORT só com vários workers: um tracker sozinho deve falhar
+        # no bind se a porta já está em uso, em vez de dividir os peers com
+        # outro processo
+        self.reuse_port = reuse_port
+        self.n_clients = 0
+        # Os logs dos comandos vão para uma fila; uma thread separada faz o
+        # write no stdout, fora do caminho do reator. Com verbose=False (ou
+        # python -O) as mensagens nem são formatadas
+        self.verbose = verbose
+        self.log_q = queue.SimpleQueue()
+        threading.Thread(target=self._drain_log, daemon=True).start()
+        self.shards = [PeerShard() for _ in range(N_SHARDS)]
+        # Resposta do GET_PEERS já serializada, como (versão, bytes). Toda
+        # escrita gera uma versão nova; next() de um itertools.count é atômico
+        self._versions = itertools.count()
+        self._peers_version = next(self._versions)
+        self._peer_list_cache = None
+
+        # Heap (expiry, peer_id) para o reaper só olhar quem expirou. Cada
+        # peer tem uma única entrada viva; o KEEPALIVE só grava o timestamp
+        # e o reaper reagenda a entrada quando ela vence antes da hora
+        self.expiry_heap = []
+        self.heap_lock = threading.Lock()
+        # (caminho, inode) do socket AF_UNIX, se este processo o criou
+        self._unix_path = None
 
     def start(self):
-        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sock.bind((self.host, self.port))
-        server_sock.listen(5)
-        print(f"[TRACKER] Servindo em {self.host}:{self.port}")
+        server_sock = self._bind_tcp_socket()
 
         # Inicia a thread para remover peers inativos
         t = threading.Thread(target=self.remove_inactive_peers, daemon=True)
         t.start()
 
-        while True:
+        # Reator de uma thread só: os comandos são operações em memória, então
+        # são executados direto no loop, sem troca de contexto por conexão
+        self.sel = selectors.DefaultSelector()
+        # Só a thread do selector lê dos sockets, então um único buffer basta
+        self._recv_buf = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buf)
+        self.sel.register(server_sock, selectors.EVENT_READ, None)
+        unix_sock = self._bind_unix_socket()
+        if unix_sock is not None:
+            self.sel.register(unix_sock, selectors.EVENT_READ, None)
+        monotonic = time.monotonic
+        try:
+            while True:
+                events = self.sel.select()
+                # Um único relógio por volta do loop, repassado aos comandos
+                now = monotonic()
+                for key, mask in events:
+                    if key.data is None:
+                        self._accept_client(key.fileobj)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._read_client(key.fileobj, key.data, now)
+                    if mask & selectors.EVENT_WRITE and not key.data["closed"]:
+                        self._write_client(key.fileobj, key.data)
+        finally:
+            # Ctrl+C ou erro fatal: não deixa o socket AF_UNIX órfão
+            self._unlink_unix_socket()
+
+    def start_asyncio(self):
+        # Alternativa ao reator com selectors: os mesmos sockets e o mesmo
+        # processamento de comandos sobre asyncio, com o loop do uvloop
+        # quando ele está instalado
+        loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        t = threading.Thread(target=self.remove_inactive_peers, daemon=True)
+        t.start()
+        try:
+            loop.run_until_complete(self._serve_asyncio(loop))
+            loop.run_forever()
+        finally:
+            self._unlink_unix_socket()
+
+    async def _serve_asyncio(self, loop):
+        factory = lambda: _TrackerProtocol(self)
+        await loop.create_server(factory, sock=self._bind_tcp_socket())
+        unix_sock = self._bind_unix_socket()
+        if unix_sock is not None:
+            await loop.create_unix_server(factory, sock=unix_sock)
+
+    def _bind_tcp_socket(self):
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Desativa o Nagle; alguns sistemas herdam a opção nos sockets aceitos
+        if hasattr(socket, "TCP_NODELAY"):
+            server_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Vários processos podem escutar na mesma porta; o kernel distribui os accept()
+        if self.reuse_port:
+            server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_sock.bind((self.host, self.port))
+        server_sock.listen(LISTEN_BACKLOG)
+        server_sock.setblocking(False)
+        print(f"[TRACKER] Servindo em {self.host}:{self.port}")
+        return server_sock
+
+    def _bind_unix_socket(self):
+        # Peers locais evitam a pilha TCP/IP usando um socket AF_UNIX
+        if not hasattr(socket, "AF_UNIX") or self.host not in ("0.0.0.0", "127.0.0.1", "localhost"):
+            return None
+        path = protocol.unix_socket_path(self.port)
+        if path is None:
+            return None
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                # Outro worker já atende neste caminho
+                return None
+            except OSError:
+                os.unlink(path)
+            finally:
+                probe.close()
+        unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            unix_sock.bind(path)
+        except OSError as e:
+            print(f"[TRACKER] Não foi possível abrir {path}: {e}")
+            unix_sock.close()
+            return None
+        unix_sock.listen(LISTEN_BACKLOG)
+        unix_sock.setblocking(False)
+        # Guarda o inode para apagar no fim só o socket criado aqui
+        self._unix_path = (path, os.stat(path).st_ino)
+        print(f"[TRACKER] Servindo peers locais em {path}")
+        return unix_sock
+
+    def _unlink_unix_socket(self):
+        if self._unix_path is None:
+            return
+        path, ino = self._unix_path
+        self._unix_path = None
+        try:
+            if os.stat(path).st_ino == ino:
+                os.unlink(path)
+        except OSError:
+            pass
+
+    def _accept_client(self, server_sock):
+        try:
             conn, addr = server_sock.accept()
-            threading.Thread(target=self.handle_client, args=(conn, addr)).start()
+        except BlockingIOError:
+            return
+        if self.n_clients >= self.max_connections + REFUSE_BACKLOG:
+            conn.close()
+            return
+        busy = self.n_clients >= self.max_connections
+        self.n_clients += 1
+        if conn.family == socket.AF_INET and hasattr(socket, "TCP_NODELAY"):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.setblocking(False)
+        state = {
+            "addr": addr or "AF_UNIX",
+            "buf": bytearray(),
+            # Respostas pendentes como lista de buffers: o GET_PEERS em cache
+            # entra por referência, sem ser copiado para um bytearray
+            "out": deque(),
+            # Bytes em "out"; acima de OUT_HIGH_WATER a leitura é suspensa
+            "out_bytes": 0,
+            # Comandos completos ficaram em "buf" porque a fila encheu
+            "backlog": False,
+            # Fecha assim que "out" esvaziar, sem ler mais nada
+            "closing": False,
+            # Acima de max_connections: o primeiro pedido recebe ERROR BUSY
+            "busy": busy,
+            "closed": False
+        }
+        self.sel.register(conn, selectors.EVENT_READ, state)
+
+    def _close_client(self, conn, state):
+        state["closed"] = True
+        self.n_clients -= 1
+        self.sel.unregister(conn)
+        conn.close()
+
+    def _read_client(self, conn, state, now):
+        try:
+            n = conn.recv_into(self._recv_buf)
+        except BlockingIOError:
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self._close_client(conn, state)
+            return
+
+        buf = state["buf"]
+        buf += self._recv_view[:n]
+        out = state["out"]
+        pending = bool(out)
+        self._serve_client(state, now)
+
+        # Se já havia saída pendente, o EVENT_WRITE continua responsável por ela
+        if out and not pending:
+            self._write_client(conn, state)
+        else:
+            self._update_events(conn, state)
+
+    def _serve_client(self, state, now):
+        # Executa os comandos de "buf" até a fila de saída chegar ao limite
+        limit = OUT_HIGH_WATER - state["out_bytes"]
+        out = state["out"]
+        queued = self._process_buffer(state["buf"], out, state["addr"], now, limit, state["busy"])
+        if queued < 0:
+            state["closing"] = True
+            state["backlog"] = False
+            state["out_bytes"] = sum(map(len, out))
+            return
+        state["backlog"] = queued >= limit
+        state["out_bytes"] += queued
+
+    def _process_buffer(self, buf, out, addr, now, limit, busy=False):
+        # Cada mensagem é (opcode, payload); opcode None = comando em texto.
+        # pos avança sobre as mensagens completas e o buffer só é compactado
+        # uma vez no fim, em vez de um del por comando. Para quando as
+        # respostas somam limit bytes; devolve quantos bytes entraram em
+        # out, ou -1 se a conexão deve ser fechada depois de enviá-los
+        queued = 0
+        pos = 0
+        size_buf = len(buf)
+        header_size = protocol.HEADER.size
+        while pos < size_buf and queued < limit:
+            if buf[pos] in protocol.OP_NAMES:
+                if size_buf - pos < header_size:
+                    break
+                op, size = protocol.HEADER.unpack_from(buf, pos)
+                start = pos + header_size
+                end = start + size
+                if size_buf < end:
+                    break
+                data = bytes(buf[start:end])
+                pos = end
+            else:
+                nl = buf.find(b"\n", pos)
+                if nl < 0:
+                    if size_buf - pos > MAX_LINE_SIZE:
+                        # Sem o fim da linha não dá para achar o próximo comando
+                        out.append(_LINE_TOO_LONG)
+                        return -1
+                    break
+                op, data = None, bytes(buf[pos:nl])
+                pos = nl + 1
+            resp = _BUSY if busy else self.handle_message(op, data, addr, now)
+            if op is not None:
+                # Frame: prefixo de tamanho num buffer separado; o sendmsg
+                # junta os dois sem copiar o corpo
+                out.append(protocol.RESPONSE_HEADER.pack(len(resp)))
+                queued += protocol.RESPONSE_HEADER.size
+            if resp:
+                out.append(resp)
+                queued += len(resp)
+            if busy:
+                # Conexão acima do limite: só o primeiro pedido é respondido,
+                # no formato em que veio, para o cliente entender a recusa
+                return -1
+        if pos:
+            del buf[:pos]
+        return queued
+
+    def _write_client(self, conn, state):
+        out = state["out"]
+        try:
+            if _HAS_SENDMSG:
+                # Um único syscall scatter-gather para várias respostas
+                sent = conn.sendmsg(list(itertools.islice(out, SENDMSG_MAX_BUFFERS)))
+            else:
+                sent = conn.send(out[0])
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close_client(conn, state)
+            return
+        state["out_bytes"] -= sent
+        # Um buffer enviado pela metade vira uma memoryview do restante,
+        # retomada no próximo EVENT_WRITE
+        while sent:
+            chunk = out[0]
+            if sent < len(chunk):
+                out[0] = memoryview(chunk)[sent:]
+                break
+            sent -= len(chunk)
+            out.popleft()
+        if state["backlog"] and state["out_bytes"] < OUT_HIGH_WATER and not state["closing"]:
+            # Comandos que ficaram em "buf" enquanto a fila estava cheia
+            self._serve_client(state, time.monotonic())
+        self._update_events(conn, state)
+
+    def _update_events(self, conn, state):
+        out = state["out"]
+        if state["closing"]:
+            if not out:
+                self._close_client(conn, state)
+                return
+            events = selectors.EVENT_WRITE
+        elif state["backlog"] or state["out_bytes"] > OUT_HIGH_WATER:
+            # Cliente que não lê as respostas: só volta a ler comandos
+            # quando a fila baixar
+            events = selectors.EVENT_WRITE
+        else:
+            # Só pede EVENT_WRITE enquanto sobrar resposta no buffer
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if out else selectors.EVENT_READ
+        if self.sel.get_key(conn).events != events:
+            self.sel.modify(conn, events, state)
 
     def remove_inactive_peers(self, timeout=60):
+        # Nomes locais: evita LOAD_GLOBAL/LOAD_ATTR a cada iteração
+        heap = self.expiry_heap
+        heappop = heapq.heappop
+        _time = time.monotonic
         while True:
-            time.sleep(10)
-            now = time.time()
-            with self.lock:
-                remove_list = []
-                for pid, info in self.peers.items():
-                    last_k = info.get("last_keepalive", None)
-                    if not last_k:
+            # Dorme até o próximo vencimento real em vez de acordar a cada 10 s
+            with self.heap_lock:
+                wait = heap[0][0] + timeout - _time() if heap else timeout
+            if wait > 0:
+                time.sleep(wait)
+
+            now = _time()
+            expired = []
+            append = expired.append
+            with self.heap_lock:
+                while heap and heap[0][0] + timeout <= now:
+                    append(heappop(heap))
+            if not expired:
+                continue
+
+            # Um lock de fatia por vez: escritas em outras fatias seguem livres
+            for expiry, peer_id in expired:
+                shard = self._shard(peer_id)
+                with shard.lock:
+                    info = shard.peers.get(peer_id)
+                    # Entrada de um registro anterior do mesmo peer_id
+                    if info is None or info.expiry != expiry:
                         continue
-                    if now - last_k > timeout:
-                        remove_list.append(pid)
-                for peer_id in remove_list:
-                    del self.peers[peer_id]
-                    print(f"[TRACKER] Peer '{peer_id}' removido por inatividade (KEEPALIVE).")
+                    last_k = info.last_keepalive
+                    if last_k + timeout > now:
+                        info.expiry = last_k
+                        self._push_expiry(last_k, peer_id)
+                        continue
+                    self._remove_peer(shard, peer_id)
+                if __debug__ and self.verbose:
+                    self.log_q.put(f"[TRACKER] Peer '{peer_id.decode()}' removido por inatividade (KEEPALIVE).")
+
+    def _drain_log(self):
+        get = self.log_q.get
+        get_nowait = self.log_q.get_nowait
+        while True:
+            batch = [get()]
+            try:
+                while len(batch) < LOG_BATCH:
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            batch.append("")
+            sys.stdout.write("\n".join(batch))
+            sys.stdout.flush()
+
+    def _push_expiry(self, last_k, peer_id):
+        with self.heap_lock:
+            heapq.heappush(self.expiry_heap, (last_k, peer_id))
+
+    def _shard(self, peer_id):
+        # O hash de bytes fica guardado no objeto: escolher a fatia é barato
+        return self.shards[hash(peer_id) & (N_SHARDS - 1)]
 
-    def handle_client(self, conn, addr):
+    def _invalidate_peer_list(self):
+        self._peers_version = next(self._versions)
+
+    def _remove_peer(self, shard, peer_id):
+        # Chamado com o lock da fatia adquirido
+        info = shard.peers.pop(peer_id)
+        shard.drop_line(peer_id)
+        self._invalidate_peer_list()
+        file_index = shard.file_index
+        for fn in info.files:
+            pids = file_index.get(fn)
+            if pids is not None:
+                pids.discard(peer_id)
+                if not pids:
+                    del file_index[fn]
+
+    def handle_message(self, op, data, addr, now=None):
+        # O protocolo é ASCII: o comando é tratado como bytes do início ao fim.
+        # Frames binários são convertidos nos mesmos campos do modo texto.
+        # now vem de time.monotonic(): relógio de parede que pula não
+        # bagunça o heap de expiração
+        if now is None:
+            now = time.monotonic()
         try:
-            data = conn.recv(4096).decode().strip()
-            if not data:
-                return
+            if op is None:
+                parts = data.split()
+                if not parts:
+                    return b""
+            else:
+                parts = protocol.decode_frame(op, data)
+            return self._handle_command(parts, addr, now)
+        except Exception as e:
+            self.log_q.put(f"[TRACKER] Erro ao processar comando: {e}")
+            return b"ERROR Comando invalido\n"
 
-            parts = data.split()
-            cmd = parts[0].upper()
-
-            print(f"[TRACKER] Recebeu comando: '{data}' de {addr}")
-
-            if cmd == "REGISTER":
-                if len(parts) >= 4:
-                    peer_id = parts[1]
-                    peer_ip = parts[2]
-                    peer_port = parts[3]
-                    file_list = parts[4].split(",") if len(parts) > 4 else []
-                    with self.lock:
-                        if peer_id in self.peers:
-                            print(f"[TRACKER] Atualizando Peer '{peer_id}' com novos arquivos: {file_list}")
-                            if "files" not in self.peers[peer_id]:
-                                self.peers[peer_id]["files"] = []
-                            self.peers[peer_id]["files"].extend(file_list)
-                            # Remove duplicatas
-                            self.peers[peer_id]["files"] = list(set(self.peers[peer_id]["files"]))
-                            if "score" not in self.peers[peer_id]:
-                                self.peers[peer_id]["score"] = 0
-                        else:
-                            print(f"[TRACKER] Registrando novo Peer '{peer_id}' com arquivos: {file_list}")
-                            self.peers[peer_id] = {
-                                "ip": peer_ip,
-                                "port": int(peer_port),
-                                "files": file_list,
-                                "last_keepalive": time.time(),
-                                "score": 0
-                            }
-                    conn.sendall(b"REGISTER_OK\n")
-                else:
-                    conn.sendall(b"ERROR Uso: REGISTER <peer_id> <ip> <port> [files]\n")
-
-            elif cmd == "UNREGISTER":
-                if len(parts) == 2:
-                    peer_id = parts[1]
-                    with self.lock:
-                        if peer_id in self.peers:
-                            del self.peers[peer_id]
-                            print(f"[TRACKER] Peer '{peer_id}' desconectado via UNREGISTER.")
-                            conn.sendall(b"UNREGISTER_OK\n")
-                        else:
-                            conn.sendall(b"ERROR Peer nao encontrado\n")
-                else:
-                    conn.sendall(b"ERROR Uso: UNREGISTER <peer_id>\n")
-
-            elif cmd == "SEARCH":
-                if len(parts) == 2:
-                    filename = parts[1]
-                    result = []
-                    with self.lock:
-                        for pid, info in self.peers.items():
-                            if filename in info["files"]:
-                                result.append((pid, info["ip"], info["port"]))
-                    if result:
-                        resp = f"SEARCH_RESULT {len(result)}\n"
-                        for (pid, ip, port) in result:
-                            resp += f"{pid} {ip} {port}\n"
-                        conn.sendall(resp.encode())
-                    else:
-                        conn.sendall(b"SEARCH_RESULT 0\n")
-                else:
-                    conn.sendall(b"ERROR Uso: SEARCH <filename>\n")
-
-            elif cmd == "GET_PEERS":
-                with self.lock:
-                    resp = f"PEER_LIST {len(self.peers)}\n"
-                    for pid, info in self.peers.items():
-                        resp += f"{pid} {info['ip']} {info['port']} {info['files']} Score={info['score']}\n"
-                conn.sendall(resp.encode())
-
-            elif cmd == "KEEPALIVE":
-                if len(parts) == 2:
-                    peer_id = parts[1]
-                    with self.lock:
-                        if peer_id in self.peers:
-                            self.peers[peer_id]["last_keepalive"] = time.time()
-                            print(f"[TRACKER] Peer '{peer_id}' enviou KEEPALIVE.")
-                            conn.sendall(b"KEEPALIVE_OK\n")
-                        else:
-                            conn.sendall(b"ERROR Peer nao encontrado para KEEPALIVE\n")
+    def _handle_command(self, parts, addr, now):
+        if __debug__ and self.verbose:
+            self.log_q.put(f"[TRACKER] Recebeu comando: '{b' '.join(parts).decode(errors='replace')}' de {addr}")
+
+        # Os clientes já enviam o comando em maiúsculas; lookup direto, sem .upper()
+        handler = self._HANDLERS.get(parts[0])
+        if handler is None:
+            return b"ERROR Comando desconhecido\n"
+        return handler(self, parts, now)
+
+    def _handle_register(self, parts, now):
+        if len(parts) >= 4:
+            peer_id = parts[1]
+            peer_ip = parts[2]
+            peer_port = parts[3]
+            file_list = parts[4].split(b",") if len(parts) > 4 else []
+            shard = self._shard(peer_id)
+            with shard.lock:
+                info = shard.peers.get(peer_id)
+                if info is not None:
+                    if __debug__ and self.verbose:
+                        self.log_q.put(f"[TRACKER] Atualizando Peer '{peer_id.decode()}' com novos arquivos: {_names(file_list)}")
+                    info.files = info.files.union(file_list)
                 else:
-                    conn.sendall(b"ERROR Uso: KEEPALIVE <peer_id>\n")
-
-            elif cmd == "INCREMENT_SCORE":
-                if len(parts) == 3:
-                    peer_id = parts[1]
-                    delta = int(parts[2])
-                    with self.lock:
-                        if peer_id in self.peers:
-                            self.peers[peer_id]["score"] += delta
-                            print(f"[TRACKER] Score de '{peer_id}' incrementado em {delta}. Novo score = {self.peers[peer_id]['score']}")
-                            conn.sendall(b"INCREMENT_OK\n")
-                        else:
-                            conn.sendall(b"ERROR Peer nao encontrado para INCREMENT_SCORE\n")
+                    if __debug__ and self.verbose:
+                        self.log_q.put(f"[TRACKER] Registrando novo Peer '{peer_id.decode()}' com arquivos: {_names(file_list)}")
+                    info = PeerInfo(
+                        ip=peer_ip,
+                        port=int(peer_port),
+                        files=frozenset(file_list),
+                        last_keepalive=now,
+                        expiry=now
+                    )
+                    shard.peers[peer_id] = info
+                    self._push_expiry(now, peer_id)
+                shard.set_line(peer_id, _peer_line(peer_id, info))
+                file_index = shard.file_index
+                for fn in file_list:
+                    file_index[fn].add(peer_id)
+                self._invalidate_peer_list()
+            return b"REGISTER_OK\n"
+        else:
+            return b"ERROR Uso: REGISTER <peer_id> <ip> <port> [files]\n"
+
+    def _handle_unregister(self, parts, now):
+        if len(parts) == 2:
+            peer_id = parts[1]
+            shard = self._shard(peer_id)
+            with shard.lock:
+                if peer_id in shard.peers:
+                    self._remove_peer(shard, peer_id)
+                    if __debug__ and self.verbose:
+                        self.log_q.put(f"[TRACKER] Peer '{peer_id.decode()}' desconectado via UNREGISTER.")
+                    return b"UNREGISTER_OK\n"
                 else:
-                    conn.sendall(b"ERROR Uso: INCREMENT_SCORE <peer_id> <delta>\n")
+                    return b"ERROR Peer nao encontrado\n"
+        else:
+            return b"ERROR Uso: UNREGISTER <peer_id>\n"
 
+    def _handle_search(self, parts, now):
+        if len(parts) == 2:
+            filename = parts[1]
+            resp = [None]
+            append = resp.append
+            for shard in self.shards:
+                with shard.lock:
+                    pids = shard.file_index.get(filename)
+                    if pids:
+                        peers = shard.peers
+                        for pid in pids:
+                            info = peers[pid]
+                            append(b"%s %s %d\n" % (pid, info.ip, info.port))
+            n = len(resp) - 1
+            if not n:
+                return _SEARCH_RESULT_N[0]
+            resp[0] = _SEARCH_RESULT_N[n] if n < len(_SEARCH_RESULT_N) else b"SEARCH_RESULT %d\n" % n
+            return b"".join(resp)
+        else:
+            return b"ERROR Uso: SEARCH <filename>\n"
+
+    def _handle_search_many(self, parts, now):
+        # SEARCH_MANY <f1> <f2> ...: todas as buscas numa única resposta,
+        # um bloco "<arquivo> <n>" seguido de <n> linhas por arquivo
+        if len(parts) < 2:
+            return b"ERROR Uso: SEARCH_MANY <filename> [filename...]\n"
+        filenames = parts[1:]
+        found = [[] for _ in filenames]
+        for shard in self.shards:
+            with shard.lock:
+                peers = shard.peers
+                get = shard.file_index.get
+                for lines, filename in zip(found, filenames):
+                    for pid in get(filename, ()):
+                        info = peers[pid]
+                        lines.append(b"%s %s %d\n" % (pid, info.ip, info.port))
+        resp = [b"SEARCH_MANY_RESULT %d\n" % len(filenames)]
+        append = resp.append
+        for lines, filename in zip(found, filenames):
+            append(b"%s %d\n" % (filename, len(lines)))
+            resp.extend(lines)
+        return b"".join(resp)
+
+    def _handle_get_peers(self, parts, now):
+        # A versão é lida antes de varrer as fatias: se alguma escrita
+        # acontecer no meio, a resposta sai mas não entra no cache
+        version = self._peers_version
+        cached = self._peer_list_cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        # Cabeçalho na primeira posição da lista: um único join monta a
+        # resposta, sem a cópia extra de concatenar cabeçalho + corpo
+        lines = [None]
+        extend = lines.extend
+        for shard in self.shards:
+            with shard.lock:
+                extend(shard.lines)
+        lines[0] = b"PEER_LIST %d\n" % (len(lines) - 1)
+        resp = b"".join(lines)
+        if self._peers_version == version:
+            self._peer_list_cache = (version, resp)
+        return resp
+
+    def _handle_keepalive(self, parts, now):
+        if len(parts) == 2:
+            peer_id = parts[1]
+            # Sem lock nenhum: dict.get e a escrita do atributo são atômicos
+            # sob o GIL, e o heap só é mexido pelo reaper e pelo REGISTER
+            info = self._shard(peer_id).peers.get(peer_id)
+            if info is not None:
+                info.last_keepalive = now
+                if __debug__ and self.verbose:
+                    self.log_q.put(f"[TRACKER] Peer '{peer_id.decode()}' enviou KEEPALIVE.")
+                return b"KEEPALIVE_OK\n"
             else:
-                conn.sendall(b"ERROR Comando desconhecido\n")
-        except Exception as e:
-            print(f"[TRACKER] Erro ao processar comando: {e}")
-        finally:
-            conn.close()
+                return b"ERROR Peer nao encontrado para KEEPALIVE\n"
+        else:
+            return b"ERROR Uso: KEEPALIVE <peer_id>\n"
+
+    def _handle_increment_score(self, parts, now):
+        if len(parts) == 3:
+            peer_id = parts[1]
+            delta = int(parts[2])
+            shard = self._shard(peer_id)
+            with shard.lock:
+                info = shard.peers.get(peer_id)
+                if info is not None:
+                    info.score += delta
+                    shard.set_line(peer_id, _peer_line(peer_id, info))
+                    self._invalidate_peer_list()
+                    if __debug__ and self.verbose:
+                        self.log_q.put(f"[TRACKER] Score de '{peer_id.decode()}' incrementado em {delta}. Novo score = {info.score}")
+                    return b"INCREMENT_OK\n"
+                else:
+                    return b"ERROR Peer nao encontrado para INCREMENT_SCORE\n"
+        else:
+            return b"ERROR Uso: INCREMENT_SCORE <peer_id> <delta>\n"
+
+    _HANDLERS = {
+        b"REGISTER": _handle_register,
+        b"UNREGISTER": _handle_unregister,
+        b"SEARCH": _handle_search,
+        b"SEARCH_MANY": _handle_search_many,
+        b"GET_PEERS": _handle_get_peers,
+        b"KEEPALIVE": _handle_keepalive,
+        b"INCREMENT_SCORE": _handle_increment_score
+    }
+
+class _TrackerProtocol(asyncio.Protocol):
+    # Uma conexão de cliente no modo asyncio; o parsing e os comandos são
+    # os mesmos do reator com selectors
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.transport = None
+        self.addr = None
+        self.buf = bytearray()
+        # Leitura suspensa com comandos ainda em buf / escrita acima do limite
+        self.backlog = False
+        self.write_paused = False
+        self.busy = False
+
+    def connection_made(self, transport):
+        tracker = self.tracker
+        if tracker.n_clients >= tracker.max_connections + REFUSE_BACKLOG:
+            transport.close()
+            return
+        self.busy = tracker.n_clients >= tracker.max_connections
+        tracker.n_clients += 1
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername") or "AF_UNIX"
+        # pause_writing/resume_writing seguram a leitura enquanto a fila
+        # de saída estiver acima do limite
+        transport.set_write_buffer_limits(high=OUT_HIGH_WATER)
+
+    def connection_lost(self, exc):
+        if self.transport is not None:
+            self.tracker.n_clients -= 1
+            self.transport = None
+
+    def data_received(self, data):
+        if self.transport is None:
+            return
+        self.buf += data
+        self._serve()
+
+    def _serve(self):
+        transport = self.transport
+        if transport is None or transport.is_closing():
+            return
+        limit = OUT_HIGH_WATER - transport.get_write_buffer_size()
+        out = []
+        queued = self.tracker._process_buffer(self.buf, out, self.addr, time.monotonic(), limit, self.busy)
+        if out:
+            transport.writelines(out)
+        if queued < 0:
+            # close() ainda envia o que já está no buffer de saída
+            transport.close()
+            return
+        if queued >= limit:
+            # Fila cheia: o resto de buf espera o resume_writing, ou a
+            # próxima volta do loop se a escrita não chegou a pausar
+            if not self.backlog:
+                self.backlog = True
+                transport.pause_reading()
+            if not self.write_paused:
+                asyncio.get_running_loop().call_soon(self._serve)
+        elif self.backlog:
+            self.backlog = False
+            transport.resume_reading()
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.backlog:
+            self._serve()
+
+def _run_worker(host, port, use_asyncio=False, reuse_port=False):
+    tracker = Tracker(host=host, port=port, reuse_port=reuse_port)
+    if use_asyncio:
+        tracker.start_asyncio()
+    else:
+        tracker.start()
+
+def run_tracker(host="0.0.0.0", port=5000, n_workers=1, use_asyncio=False):
+    # Cada worker é um processo com sua própria tabela de peers (visão
+    # parcial): um peer fica no worker que aceitou sua conexão persistente
+    if n_workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("[TRACKER] SO_REUSEPORT indisponível; usando um único worker.")
+        n_workers = 1
+    if n_workers > 1:
+        print(f"[TRACKER] Aviso: {n_workers} workers, cada um com sua própria tabela de peers. "
+              "SEARCH e GET_PEERS só enxergam os peers do worker que atendeu a conexão.")
+    reuse_port = n_workers > 1
+    for _ in range(n_workers - 1):
+        multiprocessing.Process(target=_run_worker, args=(host, port, use_asyncio, reuse_port), daemon=True).start()
+    _run_worker(host, port, use_asyncio, reuse_port)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Modo de uso:")
-        print("  python tracker.py tracker")
+        print("  python tracker.py tracker [n_workers] [asyncio]")
+        print("  n_workers > 1: cada worker tem sua própria tabela de peers, e SEARCH/GET_PEERS")
+        print("  só veem os peers registrados no mesmo worker")
         sys.exit(0)
 
     mode = sys.argv[1].lower()
     if mode == "tracker":
-        tracker = Tracker(host="0.0.0.0", port=5000)
-        tracker.start()
+        n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        use_asyncio = len(sys.argv) > 3 and sys.argv[3].lower() == "asyncio"
+        run_tracker(host="0.0.0.0", port=5000, n_workers=n_workers, use_asyncio=use_asyncio)
     else:
         print("Modo inválido. Use 'tracker'.")